@@ -1,7 +1,7 @@
 import csv
-import json
 import sys
 
+import orjson
 import typer
 
 from datagovindia import api, db, metadata
@@ -9,12 +9,18 @@ from datagovindia import api, db, metadata
 app = typer.Typer()
 
 
+def to_json(data) -> str:
+    # Pass datetimes through to `default` so they keep their `str()` format
+    options = orjson.OPT_INDENT_2 | orjson.OPT_PASSTHROUGH_DATETIME
+    return orjson.dumps(data, option=options, default=str).decode()
+
+
 @app.command()
-def refresh(full: bool = False):
+def refresh(full: bool = False, tokenizer: metadata.Tokenizer | None = None):
     """Refresh local metadata db"""
 
     with db.engine.connect() as conn:
-        metadata.refresh(conn, full=full)
+        metadata.refresh(conn, full=full, tokenizer=tokenizer)
 
 
 @app.command()
@@ -72,7 +78,7 @@ def recently_updated(
             conn, days=days, max_results=max_results, fields=fields
         )
 
-    typer.echo(json.dumps(results, indent=4, default=str))
+    typer.echo(to_json(results))
 
 
 @app.command()
@@ -86,7 +92,7 @@ def recently_created(
             conn, days=days, max_results=max_results, fields=fields
         )
 
-    typer.echo(json.dumps(results, indent=4, default=str))
+    typer.echo(to_json(results))
 
 
 @app.command()
@@ -119,7 +125,7 @@ def search(
             fields=fields,
         )
 
-    typer.echo(json.dumps(results, indent=4, default=str))
+    typer.echo(to_json(results))
 
 
 @app.command()
@@ -140,7 +146,7 @@ def info(
     result.pop("records")
 
     if format == "json":
-        typer.echo(json.dumps(result, indent=4, default=str))
+        typer.echo(to_json(result))
     else:
         typer.echo(result)
 
@@ -169,7 +175,7 @@ def preview(
     data = resource["records"]
 
     if format == "json":
-        typer.echo(json.dumps(data, indent=4, default=str))
+        typer.echo(to_json(data))
     else:
         typer.echo(data)
 
@@ -199,10 +205,16 @@ def stream(
     file = output or sys.stdout
     writer = csv.DictWriter(file, fieldnames=row.keys())
     writer.writeheader()
-    writer.writerow(row)
 
+    batch = [row]
     for row in records:
-        writer.writerow(row)
+        batch.append(row)
+        if len(batch) >= 1024:
+            writer.writerows(batch)
+            batch.clear()
+
+    writer.writerows(batch)
+    file.flush()
 
 
 def main():
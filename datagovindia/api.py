@@ -1,7 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from typing import Iterable
+from urllib.parse import urlencode
 
+import orjson
 import requests
 import sqlalchemy as sa
 
@@ -37,6 +40,7 @@ def get_resource(
     limit: int | None = None,
     filters: dict[str, str] | None = None,
     fields: list[str] | None = None,
+    timeout: int = 30,
 ) -> dict:
     """Get data from the API"""
 
@@ -46,24 +50,25 @@ def get_resource(
         log.warn(f"Using sample API key with limitations")
         api_key = config.DATAGOVINDIA_SAMPLE_API_KEY
 
-    url = f"https://api.data.gov.in/resource/{index_name}?api-key={api_key}&format={format}"
+    params = [("api-key", api_key), ("format", format)]
 
     if offset is not None:
-        url += f"&offset={offset}"
+        params.append(("offset", offset))
 
     if limit is not None:
-        url += f"&limit={limit}"
+        params.append(("limit", limit))
 
     if filters is not None:
-        for k, v in filters.items():
-            url += f"&filter[{k}]={v}"
+        params.extend((f"filter[{k}]", v) for k, v in filters.items())
 
     if fields is not None:
-        url += f"&fields={','.join(fields)}"
+        params.append(("fields", ",".join(fields)))
+
+    url = f"https://api.data.gov.in/resource/{index_name}?{urlencode(params)}"
 
     log.info(f"Getting data from {url}")
-    r = requests.get(url)
-    return r.json()
+    r = requests.get(url, timeout=(timeout, timeout + 15))
+    return orjson.loads(r.content)
 
 
 @dataclass
@@ -95,9 +100,8 @@ class ResourceApi:
         filters: dict[str, str] | None = None,
         fields: list[str] | None = None,
     ) -> Iterable[dict]:
-        results = []
-        while True:
-            results = get_resource(
+        def fetch(offset: int) -> list[dict]:
+            return get_resource(
                 index_name=self.resource.index_name,
                 api_key=self.api_key,
                 offset=offset,
@@ -105,13 +109,26 @@ class ResourceApi:
                 filters=filters,
                 fields=fields,
             )["records"]
-            offset += batch_size
 
-            if not results:
-                break
+        # Fetch the next batch in the background while the current one is
+        # being consumed.
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            future = executor.submit(fetch, offset)
+            while True:
+                results = future.result()
+                offset += batch_size
+
+                if not results:
+                    break
 
-            for result in results:
-                yield result
+                future = executor.submit(fetch, offset)
+
+                for result in results:
+                    yield result
+        finally:
+            # Don't wait for the prefetched batch if the consumer stopped early
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 @dataclass
@@ -135,9 +152,12 @@ class DataGovIndia:
                 self.refresh(full=True)
             self.last_refreshed_at = datetime.now()
 
-    def refresh(self, full=False):
-        """Refresh local metadata db."""
-        meta.refresh(self.conn, full=full)
+    def refresh(self, full=False, tokenizer: meta.Tokenizer | None = None):
+        """Refresh local metadata db.
+
+        Passing `tokenizer` rebuilds the search index with it.
+        """
+        meta.refresh(self.conn, full=full, tokenizer=tokenizer)
         self.last_refreshed_at = datetime.now()
 
     def should_refresh(self) -> bool:
@@ -5,7 +5,23 @@ from datagovindia.config import DATAGOVINDIA_CACHE_DIR
 
 path = DATAGOVINDIA_CACHE_DIR / "metadata.db"
 
-engine = sa.create_engine(f"sqlite:///{path}")
+engine = sa.create_engine(
+    f"sqlite:///{path}",
+    poolclass=sa.pool.NullPool,
+    connect_args={"check_same_thread": False},
+)
+
+
+@sa.event.listens_for(engine, "connect")
+def _pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.close()
+
 
 tf = TableFactory()
 
@@ -25,6 +41,11 @@ class Resources:
     Table = tf("resources")
 
 
+# For recency listings sorted by these columns
+sa.Index("ix_resources_updated_desc", Resources.Table.c.updated.desc())
+sa.Index("ix_resources_created_desc", Resources.Table.c.created.desc())
+
+
 class ResourcesFTS:
     index_name = tf.string("index_name")
     title = tf.string("title")
@@ -40,9 +61,15 @@ class ResourcesFTS:
     Table = tf("resources_fts")
 
 
-def drop_all():
-    tf.metadata.drop_all(engine)
+def drop_all(bind: sa.Engine | sa.Connection = engine):
+    tf.metadata.drop_all(bind)
+
+
+def create_all(bind: sa.Engine | sa.Connection = engine):
+    tf.metadata.create_all(bind)
 
 
-def create_all():
-    tf.metadata.create_all(engine)
+def create_indexes(conn: sa.Connection):
+    """Create any indexes missing from an existing db."""
+    for index in Resources.Table.indexes:
+        index.create(conn, checkfirst=True)
@@ -1,21 +1,60 @@
-import json
-import multiprocessing
-import re
-from concurrent.futures import ProcessPoolExecutor
-from dataclasses import asdict, dataclass
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from enum import Enum
 from typing import Literal
 
+import orjson
 import requests
 import sqlalchemy as sa
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from datagovindia import db
 from datagovindia.db import Resources, ResourcesFTS
 from datagovindia.logger import log
 
+POOL_SIZE = 64
 
-@dataclass
+
+class Tokenizer(str, Enum):
+    """FTS5 tokenizer used for the search index."""
+
+    porter = "porter"  # Whole word and prefix matches
+    trigram = "trigram"  # Substring matches, larger index
+
+
+FTS_OPTIONS = {
+    Tokenizer.porter: "tokenize='porter unicode61 remove_diacritics 1', prefix='2 3 4'",
+    Tokenizer.trigram: "tokenize='trigram'",
+}
+
+_RES_COLS = Resources.Table.columns
+_RES_COL_NAMES = tuple(_RES_COLS.keys())
+_RES_COL_MAP = {c.name: c for c in _RES_COLS}
+
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=POOL_SIZE,
+        pool_maxsize=POOL_SIZE,
+        # Return the last response once retries run out so that the failed batch
+        # gets skipped with a warning instead of aborting the whole refresh
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+@dataclass(slots=True)
 class ResourceMetadata:
     index_name: str
     title: str
@@ -43,8 +82,23 @@ class ResourceMetadata:
             field=list({r["id"] for r in raw.get("field", [])}),
         )
 
+    def to_row(self) -> dict:
+        """Shallow alternative to `asdict()` for db writes."""
+        return {
+            "index_name": self.index_name,
+            "title": self.title,
+            "desc": self.desc,
+            "org": self.org,
+            "org_type": self.org_type,
+            "source": self.source,
+            "sector": self.sector,
+            "field": self.field,
+            "created": self.created,
+            "updated": self.updated,
+        }
+
 
-@dataclass
+@dataclass(slots=True)
 class FetchedBatch:
     resources: list[ResourceMetadata]
 
@@ -75,7 +129,7 @@ class FetchedBatch:
         log.info(f"Fetching {url}")
         resp = fetch(url)
         try:
-            recs = resp.json()["records"]
+            recs = orjson.loads(resp.content)["records"]
             return cls.from_raw_records(recs)
         except Exception as e:
             url = resp.request.url
@@ -103,23 +157,21 @@ def gen_url(
 
 
 def fetch(url: str, timeout: int = 30) -> requests.Response:
-    return requests.get(url, timeout=(timeout, timeout + 15))
+    return SESSION.get(url, timeout=(timeout, timeout + 15))
 
 
 def clean_text(text):
-    text = re.sub(" +", " ", text).strip()
-    return text
+    return " ".join(text.split()) if text else ""
 
 
 def get_timestamp(t: int | str) -> datetime | None:
     try:
-        return datetime.fromtimestamp(int(t))
-    except Exception:
-        pass
-
-    try:
-        return datetime.fromtimestamp(int(t) / 1000)
-    except Exception:
+        n = int(t)
+        # Anything past year 2286 in seconds is a milliseconds epoch
+        if n > 10_000_000_000:
+            n /= 1000
+        return datetime.fromtimestamp(n)
+    except (TypeError, ValueError, OverflowError, OSError):
         log.warn(f"Invalid timestamp: {repr(t)}")
         return None
 
@@ -131,21 +183,17 @@ def list_org_types(conn: sa.Connection) -> list[str]:
 
 
 def list_orgs(conn: sa.Connection) -> list[str]:
-    q = sa.select(Resources.org).distinct()
-    results = set()
-    for (r,) in conn.execute(q).fetchall():
-        results.update(r)
-
-    return list(results)
+    table = Resources.Table.name
+    q = sa.text(f"SELECT DISTINCT value FROM {table}, json_each({table}.org)")
+    result = conn.execute(q).fetchall()
+    return [r for r, in result]
 
 
 def list_sectors(conn: sa.Connection) -> list[str]:
-    q = sa.select(Resources.sector).distinct()
-    results = set()
-    for (r,) in conn.execute(q).fetchall():
-        results.update(r)
-
-    return list(results)
+    table = Resources.Table.name
+    q = sa.text(f"SELECT DISTINCT value FROM {table}, json_each({table}.sector)")
+    result = conn.execute(q).fetchall()
+    return [r for r, in result]
 
 
 def list_sources(conn: sa.Connection) -> list[str]:
@@ -170,9 +218,9 @@ def list_recently_updated(
     fields: list[str] | None = None,
 ) -> list[dict]:
     if not fields:
-        fields = Resources.Table.columns.keys()
+        fields = _RES_COL_NAMES
 
-    cols = [c for c in Resources.Table.columns if c.name in fields]
+    cols = [_RES_COL_MAP[n] for n in fields]
 
     now = datetime.now()
     past = now - timedelta(days=days)
@@ -184,16 +232,17 @@ def list_recently_updated(
         .limit(max_results)
     )
 
-    results = conn.execute(q).mappings()
-    return [{f: r[f] for f in fields} for r in results]
+    results = conn.execute(q)
+    keys = [str(k) for k in results.keys()]
+    return [dict(zip(keys, r)) for r in results]
 
 
 def list_recently_created(
     conn: sa.Connection, days=7, max_results=10, fields: list[str] | None = None
 ) -> list[dict]:
     if not fields:
-        fields = Resources.Table.columns.keys()
-    cols = [c for c in Resources.Table.columns if c.name in fields]
+        fields = _RES_COL_NAMES
+    cols = [_RES_COL_MAP[n] for n in fields]
 
     now = datetime.now()
     past = now - timedelta(days=days)
@@ -205,8 +254,9 @@ def list_recently_created(
         .limit(max_results)
     )
 
-    results = conn.execute(q).mappings()
-    return [{f: r[f] for f in fields} for r in results]
+    results = conn.execute(q)
+    keys = [str(k) for k in results.keys()]
+    return [dict(zip(keys, r)) for r in results]
 
 
 def search(
@@ -221,8 +271,8 @@ def search(
     fields: list[str] | None = None,
 ) -> list[dict]:
     if not fields:
-        fields = Resources.Table.columns.keys()
-    cols = [c for c in Resources.Table.columns if c.name in fields]
+        fields = _RES_COL_NAMES
+    cols = [_RES_COL_MAP[n] for n in fields]
     where = []
 
     if title:
@@ -238,21 +288,26 @@ def search(
     if source:
         where.append(ResourcesFTS.source.match(source))
 
+    if not where:
+        return []
+
     q = (
-        sa.select(ResourcesFTS.index_name)
+        sa.select(*cols)
+        .select_from(
+            # The external content index is keyed by the resources rowid
+            ResourcesFTS.Table.join(
+                Resources.Table,
+                sa.literal_column(f"{ResourcesFTS.Table.name}.rowid")
+                == sa.literal_column(f"{Resources.Table.name}.rowid"),
+            )
+        )
         .where(sa.and_(*where))
         .order_by(ResourcesFTS.rank)
         .limit(max_results)
     )
-
-    ids = [r for r, in conn.execute(q).fetchall()]
-    if not ids:
-        return []
-
-    q = sa.select(*cols).where(Resources.index_name.in_(ids))
-    results = conn.execute(q).mappings()
-
-    return [{f: r[f] for f in fields} for r in results]
+    results = conn.execute(q)
+    keys = [str(k) for k in results.keys()]
+    return [dict(zip(keys, r)) for r in results]
 
 
 def get_resource_info(
@@ -261,26 +316,75 @@ def get_resource_info(
     fields: list[str] | None = None,
 ) -> dict:
     if not fields:
-        fields = Resources.Table.columns.keys()
-    cols = [c for c in Resources.Table.columns if c.name in fields]
+        fields = _RES_COL_NAMES
+    cols = [_RES_COL_MAP[n] for n in fields]
 
     q = sa.select(*cols).where(Resources.index_name == index_name)
-    r = conn.execute(q).fetchone()
+    result = conn.execute(q)
+    keys = [str(k) for k in result.keys()]
+    r = result.fetchone()
 
     if not r:
         raise ValueError(f"Resource {index_name} not found")
 
-    return {f: r._mapping[f] for f in fields}
+    return dict(zip(keys, r))
+
 
+def _create_fts_table(conn: sa.Connection, tokenizer: Tokenizer = Tokenizer.porter):
+    """(Re)create the search index over the resources table.
+
+    The FTS table uses external content, so it only stores the index and reads
+    the text from the resources table. Triggers keep it in sync with writes.
+    """
+    log.info("Creating Full Text Search table")
+    table = db.Resources.Table.name
+    fts_table = db.ResourcesFTS.Table.name
+    fts_cols = [c.name for c in db.ResourcesFTS.Table.columns]
+    fts_columns = ",".join(fts_cols)
+    new_values = ",".join(f"new.{c}" for c in fts_cols)
+    old_values = ",".join(f"old.{c}" for c in fts_cols)
+
+    insert_new = f"""
+        INSERT INTO {fts_table}(rowid,{fts_columns}) VALUES (new.rowid,{new_values});
+    """
+    delete_old = f"""
+        INSERT INTO {fts_table}({fts_table},rowid,{fts_columns})
+        VALUES ('delete',old.rowid,{old_values});
+    """
+    queries = [
+        f"DROP TABLE IF EXISTS {fts_table}",
+        f"""
+        CREATE VIRTUAL TABLE {fts_table} USING FTS5(
+            {fts_columns}, content='{table}', content_rowid='rowid',
+            {FTS_OPTIONS[tokenizer]}
+        )
+        """,
+        f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_table}_ai AFTER INSERT ON {table}
+        BEGIN {insert_new} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_table}_ad AFTER DELETE ON {table}
+        BEGIN {delete_old} END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {fts_table}_au AFTER UPDATE ON {table}
+        BEGIN {delete_old} {insert_new} END
+        """,
+    ]
+    for q in queries:
+        conn.execute(sa.text(q))
+    log.info(f"Created Full Test Search table: {fts_table}")
 
-def _refresh_resources_full(conn: sa.Connection):
+
+def _rebuild_resources(conn: sa.Connection, tokenizer: Tokenizer):
     fields = {}
 
-    db.drop_all()
-    db.create_all()
+    db.drop_all(conn)
+    db.create_all(conn)
     log.info(f"Created metadata records database at {db.path}")
 
-    pool_size = multiprocessing.cpu_count()
     limit = 5000
 
     total_apis_available = fetch(gen_url(0, 1)).json()["total"]
@@ -293,20 +397,24 @@ def _refresh_resources_full(conn: sa.Connection):
     total_batches = len(batches)
 
     inserted = 0
-    with ProcessPoolExecutor(max_workers=pool_size) as executor:
-        log.info(f"Using {pool_size} processes to fetch {total_batches} batches")
-        futures = executor.map(FetchedBatch.recently_updated, batches)
+    insert = sa.insert(db.Resources.Table)
+    with ThreadPoolExecutor(max_workers=POOL_SIZE) as executor:
+        log.info(f"Using {POOL_SIZE} threads to fetch {total_batches} batches")
+        # Submit all batches up front and consume them in completion order so a
+        # slow response doesn't hold back the ones that already arrived.
+        futures = [executor.submit(FetchedBatch.recently_updated, b) for b in batches]
         futures = tqdm(
-            futures, total=total_batches, desc="Fetching & updating resources"
+            as_completed(futures),
+            total=total_batches,
+            desc="Fetching & updating resources",
         )
 
-        for batch in futures:
-            for r in batch.resources:
-                q = sa.insert(db.Resources.Table).values(asdict(r))
-                conn.execute(q)
-            conn.commit()
+        for future in futures:
+            batch = future.result()
+            rows = [r.to_row() for r in batch.resources]
+            if rows:
+                conn.execute(insert, rows)
             inserted += len(batch.resources)
-        conn.commit()
 
         if inserted != total_apis_available:
             log.warn(
@@ -315,105 +423,143 @@ def _refresh_resources_full(conn: sa.Connection):
 
         log.info(f"Valid resources: {inserted}/{total_apis_available}")
 
-    log.info("Creating Full Text Search table")
-    fts_table = db.ResourcesFTS.Table.name
-    fts_columns = ",".join(c.name for c in db.ResourcesFTS.Table.columns)
-    queries = f"""
-        DROP TABLE IF EXISTS {fts_table};
-        CREATE VIRTUAL TABLE {fts_table} USING FTS5({fts_columns}, tokenize="trigram");
-        INSERT INTO {fts_table}({fts_columns}) SELECT {fts_columns} FROM {db.Resources.Table.name};
-    """
-    for q in queries.split(";"):
-        conn.execute(sa.text(q))
-    conn.commit()
-    log.info(f"Created Full Test Search table: {fts_table}")
+    _create_fts_table(conn, tokenizer=tokenizer)
 
     return list(fields.values())
 
 
-def _refresh_resources_incremental(conn: sa.Connection):
-    q = sa.select(Resources.index_name, Resources.updated)
-    ids = {id_: upd for id_, upd in conn.execute(q).fetchall()}
-    log.info(f"Found {len(ids)} existing resources")
+def _refresh_resources_full(
+    conn: sa.Connection, tokenizer: Tokenizer = Tokenizer.porter
+):
+    # pysqlite doesn't open a transaction for DDL by itself, so begin one
+    # explicitly. The rebuild then commits once at the end, and a failed refresh
+    # leaves the existing data in place.
+    conn.commit()
+    conn.exec_driver_sql("BEGIN")
+    try:
+        fields = _rebuild_resources(conn, tokenizer=tokenizer)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
 
-    offset = 0
-    limit = 10
+    return fields
 
-    fts_cols = [c.name for c in db.ResourcesFTS.Table.columns]
 
-    updated: list[ResourceMetadata] = []
-    created: list[ResourceMetadata] = []
-
-    log.info(f"Fetching recently updated resources")
-    all_updated = False
-    while not all_updated:
-        batch = FetchedBatch.recently_updated((offset, limit))
-        if not batch.resources:
-            break
-        for r in batch.resources:
-            if r.index_name in ids and ids[r.index_name] >= r.updated:
-                all_updated = True
+def _fetch_incremental(ids: dict, out: queue.Queue, stop: threading.Event):
+    """Put batches of new or updated resources on `out`, then `None`."""
+    try:
+        log.info(f"Fetching recently updated resources")
+        found = 0
+        offset, limit = 0, 10
+        while not stop.is_set():
+            batch = FetchedBatch.recently_updated((offset, limit))
+            if not batch.resources or any(
+                r.index_name in ids and ids[r.index_name] >= r.updated
+                for r in batch.resources
+            ):
                 break
-        if all_updated:
-            break
-        updated.extend(batch.resources)
-        offset += limit
-        limit = min(5000, limit * 2)
-    log.info(f"Found {len(updated)} recently updated resources")
-
-    log.info(f"Fetching recently created resources")
-    all_updated = False
-    while not all_updated:
-        batch = FetchedBatch.recently_created((offset, limit))
-        if not batch.resources:
-            break
-        for r in batch.resources:
-            if r.index_name in ids:
-                all_updated = True
+            out.put(batch)
+            found += len(batch.resources)
+            offset += limit
+            limit = min(5000, limit * 2)
+        log.info(f"Found {found} recently updated resources")
+
+        log.info(f"Fetching recently created resources")
+        found = 0
+        offset, limit = 0, 10
+        while not stop.is_set():
+            batch = FetchedBatch.recently_created((offset, limit))
+            if not batch.resources or any(r.index_name in ids for r in batch.resources):
                 break
-        if all_updated:
-            break
-
-        created.extend(batch.resources)
-        offset += limit
-        limit = min(5000, limit * 2)
-    log.info(f"Found {len(created)} recently created resources")
-
-    # Sort to make the operation atomic
-    updated.sort(key=lambda r: r.updated or datetime.max)
-    created.sort(key=lambda r: r.created or datetime.max)
-
-    for r in tqdm(updated + created, desc="Updating resources"):
-        res = asdict(r)
-        fts = {
-            c: res[c] if isinstance(res[c], str) else json.dumps(res[c])
-            for c in fts_cols
-            if c in res
-        }
+            out.put(batch)
+            found += len(batch.resources)
+            offset += limit
+            limit = min(5000, limit * 2)
+        log.info(f"Found {found} recently created resources")
+    finally:
+        out.put(None)
+
+
+def _write_incremental(
+    conn: sa.Connection, resources: list[ResourceMetadata], ids: dict
+):
+    # Later entries win, same as applying them one by one
+    latest = {r.index_name: r for r in resources}
+
+    insert_rows, update_rows = [], []
+    for r in latest.values():
+        res = r.to_row()
         if r.index_name in ids:
-            rq = (
-                sa.update(db.Resources.Table)
-                .where(Resources.index_name == r.index_name)
-                .values(res)
-            )
-            fq = (
-                sa.update(db.ResourcesFTS.Table)
-                .where(ResourcesFTS.index_name == r.index_name)
-                .values(fts)
-            )
-
+            update_rows.append({**res, "_id": r.index_name})
         else:
-            rq = sa.insert(db.Resources.Table).values(res)
-            fq = sa.insert(db.ResourcesFTS.Table).values(fts)
-        conn.execute(rq)
-        conn.execute(fq)
+            insert_rows.append(res)
 
         ids[r.index_name] = r.updated
-        conn.commit()
+
+    # The search index is kept in sync by triggers on the resources table
+    if insert_rows:
+        conn.execute(sa.insert(db.Resources.Table), insert_rows)
+
+    if update_rows:
+        q = sa.update(db.Resources.Table).where(
+            Resources.index_name == sa.bindparam("_id")
+        )
+        conn.execute(q, update_rows)
 
 
-def refresh(conn: sa.Connection, full=False):
+def _refresh_resources_incremental(
+    conn: sa.Connection, tokenizer: Tokenizer | None = None
+):
+    db.create_indexes(conn)
+
+    # Databases built before the search index used external content store their
+    # own copy of the text and have no sync triggers
+    q = sa.text("SELECT sql FROM sqlite_master WHERE name = :name")
+    fts_sql = conn.execute(q, {"name": db.ResourcesFTS.Table.name}).scalar() or ""
+    # Keep the tokenizer the index was built with, older dbs use trigram
+    current = Tokenizer.trigram if "trigram" in fts_sql else Tokenizer.porter
+    if "content=" not in fts_sql or (tokenizer and tokenizer != current):
+        _create_fts_table(conn, tokenizer=tokenizer or current)
+
+    q = sa.select(Resources.index_name, Resources.updated)
+    ids = {id_: upd for id_, upd in conn.execute(q).fetchall()}
+    log.info(f"Found {len(ids)} existing resources")
+
+    # Fetch in a background thread while this one writes to the db. The fetcher
+    # gets its own copy of the ids so that our writes don't move its stop point.
+    batches: queue.Queue[FetchedBatch | None] = queue.Queue(maxsize=4)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        fetcher = executor.submit(_fetch_incremental, dict(ids), batches, stop)
+
+        drained = False
+        try:
+            with tqdm(desc="Updating resources") as progress:
+                while (batch := batches.get()) is not None:
+                    _write_incremental(conn, batch.resources, ids)
+                    progress.update(len(batch.resources))
+            drained = True
+        finally:
+            if not drained:
+                # Unblock the fetcher so it can stop
+                stop.set()
+                while batches.get() is not None:
+                    pass
+
+        fetcher.result()
+
+    conn.commit()
+
+
+def refresh(conn: sa.Connection, full=False, tokenizer: Tokenizer | None = None):
+    """Refresh the metadata db.
+
+    A full refresh builds the search index with `tokenizer` (porter by default).
+    An incremental refresh keeps the existing tokenizer unless one is given, in
+    which case the index is rebuilt with it.
+    """
     if full:
-        _refresh_resources_full(conn)
+        _refresh_resources_full(conn, tokenizer=tokenizer or Tokenizer.porter)
     else:
-        _refresh_resources_incremental(conn)
+        _refresh_resources_incremental(conn, tokenizer=tokenizer)